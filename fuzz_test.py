@@ -3,14 +3,12 @@ import argparse
 import tempfile
 import os
 import random
-from subprocess import call
-import filecmp
+import shutil
+import itertools
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from fasm_utils.database import Database
-
-
-parser = argparse.ArgumentParser(description="qlfasm disassembler fuzz test")
-parser.add_argument("-o", "--outdir", help="Where to store generated files")
-args = parser.parse_args()
+from quicklogic_fasm.qlfasm import (
+    load_quicklogic_database, assemble_file, disassemble_file)
 
 
 MIN_FEATURES = 1
@@ -20,91 +18,115 @@ DB_FILES_DIR = os.path.join(
     os.path.dirname(__file__),
     'quicklogic_fasm',
     'ql732b')
-QLFASM_PATH = os.path.join(
-    os.path.dirname(__file__), 'quicklogic_fasm', 'qlfasm.py')
 
-print('\rLoading db...\033[K', end='')
+# Per-worker state, set up by init_worker
+features = None
+qlfasm_db = None
+tmpdir = None
+outdir = None
 
-db = Database(DB_FILES_DIR)
-db.add_table('macro', os.path.join(DB_FILES_DIR, 'macro.db'))
-db.add_table('colclk', os.path.join(DB_FILES_DIR, 'colclk.db'))
-db.add_table('testmacro', os.path.join(DB_FILES_DIR, 'testmacro.db'))
-features = [f.signature for f in db]
-del db
 
-tmpdir = None
-tmpdir_obj = None
-if not args.outdir:
-    tmpdir_obj = tempfile.TemporaryDirectory(prefix='qlfasm-fuzzer-')
-    tmpdir = tmpdir_obj.name
-else:
-    if os.path.isdir(args.outdir):
-        tmpdir = args.outdir
-        os.makedirs(os.path.join(tmpdir, 'failed'))
-        os.makedirs(os.path.join(tmpdir, 'passed'))
-    else:
-        raise NotADirectoryError
+def init_worker(worker_tmpdir, worker_outdir):
+    '''Loads the databases once for every worker process.'''
+    global features, qlfasm_db, tmpdir, outdir
+
+    db = Database(DB_FILES_DIR)
+    db.add_table('macro', os.path.join(DB_FILES_DIR, 'macro.db'))
+    db.add_table('colclk', os.path.join(DB_FILES_DIR, 'colclk.db'))
+    db.add_table('testmacro', os.path.join(DB_FILES_DIR, 'testmacro.db'))
+    features = [f.signature for f in db]
+    del db
+
+    # The assembler database is loaded once and reused by all tests
+    qlfasm_db = load_quicklogic_database(DB_FILES_DIR)
+
+    tmpdir = worker_tmpdir
+    outdir = worker_outdir
+
+    # Forked workers inherit the random state, reseed so that they do not
+    # all generate the same tests
+    random.seed()
 
 
 def do_test(id):
-    fasm_name = os.path.join(tmpdir, f'{id:06d}.gen.fasm')
-    bit_name = os.path.join(tmpdir, f'{id:06d}.gen.fasm.bit')
-    disasm_fasm_name = os.path.join(tmpdir, f'{id:06d}.disasm.fasm')
-    disasm_bit_name = os.path.join(tmpdir, f'{id:06d}.disasm.fasm.bit')
+    # All files of a test are kept in its own directory, so that they can be
+    # moved or removed at once
+    test_name = f'{id:06d}'
+    test_dir = os.path.join(tmpdir, 'pending', test_name)
+    os.makedirs(test_dir)
 
-    num = random.randint(MIN_FEATURES, MAX_FEATURES)
-    random_features = [
-        features[random.randint(0, len(features) - 1)] for _ in range(num)]
-    with open(fasm_name, 'w') as fasm_file:
-        print(*random_features, sep='\n', file=fasm_file)
+    fasm_name = os.path.join(test_dir, f'{test_name}.gen.fasm')
+    bit_name = os.path.join(test_dir, f'{test_name}.gen.fasm.bit')
+    disasm_fasm_name = os.path.join(test_dir, f'{test_name}.disasm.fasm')
+    disasm_bit_name = os.path.join(test_dir, f'{test_name}.disasm.fasm.bit')
 
     try:
-        call([
-            '/usr/bin/env', 'python3',
-            QLFASM_PATH, fasm_name, bit_name])
-        call([
-            '/usr/bin/env', 'python3',
-            QLFASM_PATH, '-d', bit_name, disasm_fasm_name])
-        call([
-            '/usr/bin/env', 'python3',
-            QLFASM_PATH, disasm_fasm_name, disasm_bit_name])
-
-        success = filecmp.cmp(bit_name, disasm_bit_name, shallow=False)
-
-        if args.outdir:
+        num = random.randint(MIN_FEATURES, MAX_FEATURES)
+        random_features = random.choices(features, k=num)
+        with open(fasm_name, 'w') as fasm_file:
+            fasm_file.write('\n'.join(random_features) + '\n')
+
+        assemble_file(qlfasm_db, fasm_name, bit_name)
+        disassemble_file(qlfasm_db, bit_name, disasm_fasm_name)
+        assemble_file(qlfasm_db, disasm_fasm_name, disasm_bit_name)
+
+        # Both bitstreams were just written, compare their contents directly
+        with open(bit_name, 'rb') as bit_file, \
+                open(disasm_bit_name, 'rb') as disasm_bit_file:
+            success = bit_file.read() == disasm_bit_file.read()
+
+        if outdir:
             move_to = 'passed' if success else 'failed'
-            for name in (
-                    fasm_name,
-                    bit_name,
-                    disasm_fasm_name,
-                    disasm_bit_name):
-                if os.path.exists(name):
-                    os.rename(
-                        name,
-                        os.path.join(tmpdir, move_to, os.path.basename(name)))
+            os.rename(test_dir, os.path.join(tmpdir, move_to, test_name))
         elif success:
-            for name in (
-                    fasm_name,
-                    bit_name,
-                    disasm_fasm_name,
-                    disasm_bit_name):
-                if os.path.exists(name):
-                    os.remove(name)
-    except os.error:
-        for name in (fasm_name, bit_name, disasm_fasm_name, disasm_bit_name):
-            if os.path.exists(name):
-                os.remove(name)
+            shutil.rmtree(test_dir)
+    except Exception:
+        shutil.rmtree(test_dir, ignore_errors=True)
         raise
 
     return success
 
 
-print('\rRunning...\033[K', end='')
-
-num_failed = 0
-num_tests = 0
-while True:
-    if not do_test(num_tests):
-        num_failed += 1
-    num_tests += 1
-    print(f'\rFailed tests: {num_failed}/{num_tests}\033[K', end='')
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="qlfasm disassembler fuzz test")
+    parser.add_argument("-o", "--outdir", help="Where to store generated files")
+    parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of tests run in parallel (def. number of CPUs)")
+    args = parser.parse_args()
+
+    tmpdir_obj = None
+    if not args.outdir:
+        tmpdir_obj = tempfile.TemporaryDirectory(prefix='qlfasm-fuzzer-')
+        tmpdir = tmpdir_obj.name
+    else:
+        if os.path.isdir(args.outdir):
+            tmpdir = args.outdir
+            os.makedirs(os.path.join(tmpdir, 'failed'))
+            os.makedirs(os.path.join(tmpdir, 'passed'))
+        else:
+            raise NotADirectoryError
+
+    print('\rLoading db...\033[K', end='')
+
+    num_failed = 0
+    num_tests = 0
+    with ProcessPoolExecutor(
+            max_workers=args.jobs,
+            initializer=init_worker,
+            initargs=(tmpdir, args.outdir)) as executor:
+        # Keep a bounded number of tests queued, the test ids are endless
+        ids = itertools.count()
+        pending = set(executor.submit(do_test, next(ids))
+                      for _ in range(2 * args.jobs))
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if not future.result():
+                    num_failed += 1
+                num_tests += 1
+                pending.add(executor.submit(do_test, next(ids)))
+            print(f'\rFailed tests: {num_failed}/{num_tests}\033[K', end='')
@@ -1,8 +1,14 @@
 import argparse
+import array
+import sys
 from pathlib import Path
 
 header = "uint32_t	axFPGABitStream[] = {\n\t"
 footer = "\n};\n"
+
+# Number of bitstream words in a single line of the header
+WORDS_PER_LINE = 10
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description="Converts QuickLogic bitstream to header script"
@@ -22,24 +28,23 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
-    headerscript = header
-
     with open(args.infile, 'rb') as bitstream:
-        counter = 1
-        while True:
-            data = bitstream.read(4)
-            if not data:
-                break
-            bitword = int.from_bytes(data, 'little')
-            line = '0x{:08x}, '.format(bitword)
-            if(counter is 10):
-                headerscript += line + "\n\t"
-                counter = 1
-            else:
-                headerscript += line 
-                counter += 1
-    
-    data = headerscript[:-3]
+        data = bitstream.read()
+    # Zero-pad a trailing partial word, so it reads as a little-endian value
+    # like the full ones
+    data += bytes(-len(data) % 4)
+
+    bitwords = array.array('I')
+    bitwords.frombytes(data)
+    if sys.byteorder != 'little':
+        bitwords.byteswap()
+
+    words = ['0x{:08x}, '.format(bitword) for bitword in bitwords]
+    lines = [''.join(words[i:i + WORDS_PER_LINE])
+             for i in range(0, len(words), WORDS_PER_LINE)]
+
+    # Drop the space after the last word
+    data = header + '\n\t'.join(lines)[:-1]
     data += footer
     with open(args.outfile, 'w') as headerfile:
         headerfile.write(data)
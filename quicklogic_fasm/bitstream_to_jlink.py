@@ -1,6 +1,11 @@
 import argparse
+import array
+import sys
 from pathlib import Path
 
+# Number of bitstream bytes converted at once, a multiple of the word size
+READ_CHUNK_SIZE = 1 << 20
+
 header = [
     'w4 0x40004c4c 0x00000180',
     'w4 0x40004610 0x00000007',
@@ -53,18 +58,23 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
-    jlinkscript = header
-
-    with open(args.infile, 'rb') as bitstream:
+    with open(args.infile, 'rb') as bitstream, \
+            open(args.outfile, 'w') as jlink:
+        jlink.write('\n'.join(header) + '\n')
         while True:
-            data = bitstream.read(4)
+            data = bitstream.read(READ_CHUNK_SIZE)
             if not data:
                 break
-            bitword = int.from_bytes(data, 'little')
-            line = 'w4 0x40014ffc, 0x{:08x}'.format(bitword)
-            jlinkscript.append(line)
+            # Zero-pad a trailing partial word, so it reads as a little-endian
+            # value like the full ones
+            data += bytes(-len(data) % 4)
 
-    jlinkscript.extend(footer)
+            bitwords = array.array('I')
+            bitwords.frombytes(data)
+            if sys.byteorder != 'little':
+                bitwords.byteswap()
 
-    with open(args.outfile, 'w') as jlink:
-        jlink.write('\n'.join(jlinkscript))
+            jlink.write(''.join(
+                'w4 0x40014ffc, 0x{:08x}\n'.format(bitword)
+                for bitword in bitwords))
+        jlink.write('\n'.join(footer))
@@ -1,4 +1,5 @@
 import argparse
+import array
 from pathlib import Path
 import json
 
@@ -6,7 +7,10 @@ import json
 OSC_CTRL_1_REG = 0x40005484
 CLK_CONTROL_F_0_REG = 0x40004020
 
-header = [
+# Number of bitstream bytes converted at once, a multiple of the word size
+READ_CHUNK_SIZE = 1 << 20
+
+header = (
     '    mww 0x40004c4c 0x00000180',
     '    mww 0x40004610 0x00000007',
     '    mww 0x40004088 0x0000003f',
@@ -20,9 +24,19 @@ header = [
     '    sleep 100',
     '    mww 0x40014000 0x0000bdff',
     '    sleep 100',
-]
+)
+
+proc_header = (
+    'proc load_bitstream {} {',
+    '    echo "Loading bitstream..."',
+)
+
+proc_footer = (
+    '    echo "Bitstream loaded successfully!"',
+    '}',
+)
 
-footer = [
+footer = (
     '    sleep 100',
     '    mww 0x40014000 0x00000000',
     '    mww 0x400047f0 0x00000000',
@@ -37,38 +51,13 @@ footer = [
     '    sleep 100',
     '    mww 0x40004c4c 0x000009a0',
     '    sleep 100',
-]
-
-
-def gen_mww(reg, val):
-    mww = ["    mww %s %s" % (reg, val)]
-    return mww
-
-def dec2hex(val):
-    assert type(val) == str or type(val) == int
-    if type(val) == str:
-        return "0x%08x" % (int(val))
-    else:
-        return "0x%08x" % (val)
-
-def gen_osc_setting(freq):
-    reg = OSC_CTRL_1_REG
-    val = (int((freq / 32768) - 3) & 0xFFF)
-    return gen_mww(dec2hex(reg), dec2hex(val))
-
-def gen_clk_divider_setting(div):
-    reg = CLK_CONTROL_F_0_REG
-    enable = 0x200
-    assert div > 1
-    val = (div - 2) | enable
-    return gen_mww(dec2hex(reg), dec2hex(val))
-
-def gen_openocd_proc(cfg):
-    cfg.insert(0, 'proc load_bitstream {} {')
-    cfg.insert(1, '    echo "Loading bitstream..."')
-    cfg.append('    echo "Bitstream loaded successfully!"')
-    cfg.append('}')
-    return cfg
+)
+
+# Fixed parts of the script, joined once
+HEADER_STR = '\n'.join(proc_header + header) + '\n'
+FOOTER_STR = '\n'.join(footer) + '\n'
+PROC_FOOTER_STR = '\n'.join(proc_footer)
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -103,22 +92,38 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
-    openocd_script = header
+    osc_val = int((args.osc_freq / 32768) - 3) & 0xFFF
+    osc_setting = f'    mww 0x{OSC_CTRL_1_REG:08x} 0x{osc_val:08x}'
+
+    assert args.fpga_clk_divider > 1
+    # Divider value with the enable bit set
+    clk_val = (args.fpga_clk_divider - 2) | 0x200
+    clk_divider_setting = \
+        f'    mww 0x{CLK_CONTROL_F_0_REG:08x} 0x{clk_val:08x}'
+
+    with open(args.infile, 'rb') as bitstream, \
+            open(args.outfile, 'w') as openocd:
+        openocd.write(HEADER_STR)
 
-    with open(args.infile, 'rb') as bitstream:
         while True:
-            data = bitstream.read(4)
+            data = bitstream.read(READ_CHUNK_SIZE)
             if not data:
                 break
-            bitword = int.from_bytes(data, 'little')
-            line = '    mww 0x40014ffc 0x{:08x}'.format(bitword)
-            openocd_script.append(line)
-
-    openocd_script.extend(footer)
-    openocd_script.extend(gen_osc_setting(args.osc_freq))
-    openocd_script.extend(gen_clk_divider_setting(args.fpga_clk_divider))
-
-    openocd_script = gen_openocd_proc(openocd_script)
-
-    with open(args.outfile, 'w') as openocd:
-        openocd.write('\n'.join(openocd_script))
+            # Zero-pad a trailing partial word, so it reads as a little-endian
+            # value like the full ones
+            data += bytes(-len(data) % 4)
+
+            # Swap the little-endian words to big-endian, so that the hex dump
+            # of every word reads as its value
+            bitwords = array.array('I')
+            bitwords.frombytes(data)
+            bitwords.byteswap()
+            hexdata = bitwords.tobytes().hex()
+
+            openocd.write(''.join(
+                '    mww 0x40014ffc 0x' + hexdata[i:i + 8] + '\n'
+                for i in range(0, len(hexdata), 8)))
+
+        openocd.write(FOOTER_STR)
+        openocd.write(osc_setting + '\n' + clk_divider_setting + '\n')
+        openocd.write(PROC_FOOTER_STR)
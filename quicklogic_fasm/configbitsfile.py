@@ -5,28 +5,25 @@ import csv
 class MacroSpecificBit(object):
     '''Represents single entry in macro*Table_*.csv'''
 
+    __slots__ = ('full_bit_name', 'wl', 'bl',
+                 'macro_type', 'bit_type', 'bit_name')
+
     def __init__(self, full_bit_name, wl, bl):
         self.full_bit_name = full_bit_name
         self.wl = int(wl)
         self.bl = int(bl)
 
-    @property
-    def macro_type(self):
-        '''Macro type, e.g. "macro", "macro_interface", etc.'''
-        return self.full_bit_name.split('.', 2)[1]
-
-    @property
-    def bit_type(self):
-        '''Bit type, e.g. "I_highway", "I_invblock", etc.'''
-        return self.full_bit_name.split('.', 3)[2]
-
-    @property
-    def bit_name(self):
-        '''Name without macro_type prefix.'''
-        return self.full_bit_name.split('.', 2)[2]
+        _, macro_type, bit_name = full_bit_name.split('.', 2)
+        # Macro type, e.g. "macro", "macro_interface", etc.
+        self.macro_type = macro_type
+        # Bit type, e.g. "I_highway", "I_invblock", etc.
+        self.bit_type = bit_name.split('.', 1)[0]
+        # Name without macro_type prefix.
+        self.bit_name = bit_name
 
     def __repr__(self):
-        args = [f'{k}={repr(v)}' for k, v in self.__dict__.items()]
+        args = [f'{k}={repr(getattr(self, k))}'
+                for k in ('full_bit_name', 'wl', 'bl')]
         return f'{__class__.__name__}({", ".join(args)})'
 
 
@@ -35,20 +32,20 @@ class MacroSpecificBitsTable(dict):
 
     def parse(self, file_name):
         with open(file_name, 'r') as f:
-            entries = None
-            for line in csv.reader(f):
-                assert len(line) == 3, f'len(line) = {len(line)}; line = {line}'
-                entry = MacroSpecificBit(*line)
-                # All entries in file should have the same macro_type
-                if entries is None:
-                    macro_type = entry.macro_type
-                    entries = self.setdefault(macro_type, [])
-                entries.append(entry)
+            lines = list(csv.reader(f))
+        for line in lines:
+            assert len(line) == 3, f'len(line) = {len(line)}; line = {line}'
+        entries = [MacroSpecificBit(*line) for line in lines]
+        # All entries in file should have the same macro_type
+        if entries:
+            self.setdefault(entries[0].macro_type, []).extend(entries)
 
 
 class DeviceMacroCoord(object):
     '''Represents single entry in DeviceMacroCoord_*.csv'''
 
+    __slots__ = ('row', 'column', 'name', 'wl', 'bl', 'macro_type')
+
     def __init__(self, row, column, name, wl, bl, macro_type):
         self.row = int(row)
         self.column = int(column)
@@ -58,7 +55,7 @@ class DeviceMacroCoord(object):
         self.macro_type = macro_type
 
     def __repr__(self):
-        args = [f'{k}={repr(v)}' for k, v in self.__dict__.items()]
+        args = [f'{k}={repr(getattr(self, k))}' for k in self.__slots__]
         return f'{__class__.__name__}({", ".join(args)})'
 
 
@@ -66,6 +63,7 @@ class DeviceMacroCoordsTable(list):
 
     def parse(self, file_name):
         with open(file_name, 'r') as f:
-            for line in csv.reader(f):
-                assert len(line) == 6, f'len(line) = {len(line)}; line = {line}'
-                self.append(DeviceMacroCoord(*line))
+            lines = list(csv.reader(f))
+        for line in lines:
+            assert len(line) == 6, f'len(line) = {len(line)}; line = {line}'
+        self.extend(DeviceMacroCoord(*line) for line in lines)
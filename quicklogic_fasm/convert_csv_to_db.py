@@ -1,11 +1,17 @@
 #!/usr/bin/env python3
 import csv
+import sys
 import argparse
-from collections import defaultdict
+from bisect import bisect_right
+from collections import Counter
 from fasm_utils.db_entry import DbEntry
 from fasm_utils.segbits import Bit
 from techfile_to_cell_loc import TechFile
 from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
+
+# Number of DB lines collected before they are written out at once
+WRITE_BATCH_SIZE = 65536
 
 
 class QLDbEntry(DbEntry):
@@ -19,13 +25,6 @@ class QLDbEntry(DbEntry):
     ----------
     macrotype_to_celltype: dict
         Map from macro type to hardware cell type.
-    dbentrytemplate: str
-        The format for flattened macro database for QuickLogic.
-        The fields are following:
-        * site[0] - cell row
-        * site[1] - cell column
-        * ctype - cell type, can be LOGIC, QMUX, GMUX, INTERFACE
-        * spectype - the subtype for a given ctype, used to group inverters
     '''
 
     macrotype_to_celltype = {
@@ -114,9 +113,38 @@ class QLDbEntry(DbEntry):
         33: (694, 714,),
     }
 
-    dbentrytemplate = 'X{site[0]}Y{site[1]}.{ctype}.{spectype}.{sig}'
-    dbroutingentrytemplate = 'X{site[0]}Y{site[1]}.ROUTING.{sig}'
-    dbcolclkentrytemplate = 'X{site[0]}Y{site[1]}.CAND{idx}.{sig}'
+    # The grid coordinates and the low and high ends of their WL / BL
+    # ranges, sorted by the low end for bisection in `_get_grid_coord`
+    _wl_ranges = sorted((l, h, i) for i, (l, h) in wl_map.items())
+    _wl_lows = [l for l, h, i in _wl_ranges]
+    _bl_ranges = sorted((l, h, i) for i, (l, h) in bl_map.items())
+    _bl_lows = [l for l, h, i in _bl_ranges]
+
+    # Signature parts removed by `simplify_signature`, and the parts that
+    # everything before is removed, in the order they are looked for
+    simplify_removed_words = ("Ipsm", "I_jcb")
+    simplify_cut_words = ("I_highway", "I_street", "I_invblock",
+                          "Ipwr_gates", "I_if_block")
+    # Column clock joints, the "I<n>" part before them selects the CAND cell
+    colclk_joint_words = ("I_hilojoint", "I_enjoint")
+
+    # This map translates between the last "I<n>" field value and the
+    # actual CAND cell index.
+    cand_index_map = {
+        10: 0,
+        9: 1,
+        8: 2,
+        7: 3,
+        6: 4,
+    }
+
+    # The signature and coords attributes are handled by DbEntry
+    __slots__ = ('coord', 'devicecoord', 'macrotype', 'celltype',
+                 'is_routing_bit', 'is_colclk_bit', 'spectype',
+                 'originalsignature')
+
+    # Translation of the characters not readable for fasm module
+    signature_fix_table = str.maketrans('<>', '__')
 
     def __init__(self,
                  signature: str,
@@ -142,30 +170,47 @@ class QLDbEntry(DbEntry):
         parts = self.signature.split(".")
 
         # Remove "Ipsm" and "I_jcb" from the signature
-        for word in ["Ipsm", "I_jcb"]:
+        for word in self.simplify_removed_words:
             if word in parts:
                 parts.remove(word)
 
-        # Remove everything before these:
-        for word in ["I_highway", "I_street", "I_invblock", "Ipwr_gates", "I_if_block"]:
+        # Remove everything before these. Each word is looked for from the
+        # previous cut on, so only the index of the first kept part is
+        # tracked instead of slicing the parts every time.
+        start = 0
+        for word in self.simplify_cut_words:
             if word in parts:
-                idx = parts.index(word)
-                parts = parts[idx:]
+                try:
+                    start = parts.index(word, start)
+                except ValueError:
+                    pass
 
         # Remove everything before "IQTFC_Z_*"
-        for part in parts:
-            if part.startswith("IQTFC_Z_"):
-                idx = parts.index(part)
-                parts = parts[idx:]
+        for idx in range(start, len(parts)):
+            if parts[idx].startswith("IQTFC_Z_"):
+                start = idx
                 break
 
         # Remove everything before these:
-        for word in ["I_hilojoint", "I_enjoint"]:
+        for word in self.colclk_joint_words:
             if word in parts:
-                idx = parts.index(word)
-                parts = parts[idx:]
+                try:
+                    start = parts.index(word, start)
+                except ValueError:
+                    pass
 
-        self.signature = ".".join(parts)
+        self.signature = ".".join(parts[start:])
+
+    @staticmethod
+    def _find_range(ranges, lows, value):
+        """
+        Returns the grid coordinate of the range that contains the value,
+        or None if there is no such range.
+        """
+        i = bisect_right(lows, value) - 1
+        if i >= 0 and value <= ranges[i][1]:
+            return ranges[i][2]
+        return None
 
     @staticmethod
     def _get_grid_coord(wl, bl):
@@ -173,18 +218,12 @@ class QLDbEntry(DbEntry):
         Returns the device grid position as (col, row) of the a bit with the
         given wl and bl indices.
         """
-        row = None
-        col = None
-
-        for i, (l, h) in QLDbEntry.wl_map.items():
-            if wl >= l and wl <= h:
-                row = i
-                break
-
-        for i, (l, h) in QLDbEntry.bl_map.items():
-            if bl >= l and bl <= h:
-                col = i
-                break
+        row = QLDbEntry._find_range(QLDbEntry._wl_ranges,
+                                    QLDbEntry._wl_lows,
+                                    wl)
+        col = QLDbEntry._find_range(QLDbEntry._bl_ranges,
+                                    QLDbEntry._bl_lows,
+                                    bl)
 
         return col, row
 
@@ -194,22 +233,12 @@ class QLDbEntry(DbEntry):
         Extracts index of the CAND cell from the macro name
         """
 
-        # This map translates between the last "I<n>" field value and the
-        # actual CAND cell index.
-        INDEX_MAP = {
-            10: 0,
-            9: 1,
-            8: 2,
-            7: 3,
-            6: 4,
-        }
-
         # Split the signature
         parts = signature.split(".")
 
         # Get the last "I<n>" field
         for i, word in enumerate(parts):
-            if word in ["I_hilojoint", "I_enjoint"]:
+            if word in QLDbEntry.colclk_joint_words:
                 part = parts[i-1]
                 break
         else:
@@ -219,44 +248,49 @@ class QLDbEntry(DbEntry):
         idx = int(part[1:])
 
         # Remap the index
-        assert idx in INDEX_MAP, (signature, idx)
-        return INDEX_MAP[idx]
+        assert idx in QLDbEntry.cand_index_map, (signature, idx)
+        return QLDbEntry.cand_index_map[idx]
 
     def update_signature(self, simplify=False):
         '''Updates the signature for flattened entry so it follows the format
-        introduced in `dbentrytemplate`.
+        of the flattened macro database for QuickLogic.
+
+        The format is `X{site[0]}Y{site[1]}.{ctype}.{spectype}.{sig}`, where:
+
+        * site[0] - cell row
+        * site[1] - cell column
+        * ctype - cell type, can be LOGIC, QMUX, GMUX, INTERFACE
+        * spectype - the subtype for a given ctype, used to group inverters
+
+        Routing bits use `X{site[0]}Y{site[1]}.ROUTING.{sig}` and column clock
+        bits use `X{site[0]}Y{site[1]}.CAND{idx}.{sig}` instead.
         '''
 
         self.signature = self.originalsignature
 
         if self.is_routing_bit:
             self.simplify_signature()
-            self.signature = self.dbroutingentrytemplate.format(
-                site=self.devicecoord,
-                sig=self.signature)
+            site = self.devicecoord
+            self.signature = f'X{site[0]}Y{site[1]}.ROUTING.{self.signature}'
 
         elif self.is_colclk_bit:
             self.simplify_signature()
             site = self._get_grid_coord(self.coord[0], self.coord[1])
             cand = self._get_cand_index(self.originalsignature)
-            self.signature = self.dbcolclkentrytemplate.format(
-                site=site,
-                idx=cand,
-                sig=self.signature)
+            self.signature = \
+                f'X{site[0]}Y{site[1]}.CAND{cand}.{self.signature}'
 
         elif self.macrotype is not None:
             self.simplify_signature()
-            self.signature = self.dbentrytemplate.format(
-                site=self.devicecoord,
-                ctype=self.macrotype_to_celltype[self.macrotype],
-                spectype=self.spectype,
-                sig=self.signature)
+            site = self.devicecoord
+            self.signature = (f'X{site[0]}Y{site[1]}.{self.celltype}.'
+                              f'{self.spectype}.{self.signature}')
 
     @classmethod
     def _fix_signature(cls, signature: str):
         '''Removes not readable characters for fasm module from CSV entries.
         '''
-        return signature.replace('<', '_').replace('>', '_')
+        return signature.translate(cls.signature_fix_table)
 
     @classmethod
     def from_csv_line(cls, csvline: list) -> 'QLDbEntry':
@@ -267,7 +301,8 @@ class QLDbEntry(DbEntry):
     @classmethod
     def from_csv_line_unflattened(cls, csvline: list) -> 'QLDbEntry':
         '''Reads the initial DbEntry from unflattened CSV line.'''
-        macrotype = csvline[5]
+        # There are only a few macro types, share one string for each
+        macrotype = sys.intern(csvline[5])
         devicecoord = (int(csvline[1]), int(csvline[0]))
         bitcoord = (int(csvline[3]), int(csvline[4]))
         signature = cls._fix_signature(csvline[2])
@@ -278,42 +313,70 @@ class QLDbEntry(DbEntry):
                    macrotype,
                    macrotype)
 
-    def gen_flatten_macro_type(self, macrodbdata: list, invertermap: dict):
-        '''Flattens the unflattened DbEntry based on the entries from the list
-        of DbEntry objects that match the macrotype of this DbEntry and yields
-        all flattened entries.
+    @staticmethod
+    def strip_macro_type(macrotype: str, macrodbdata: list):
+        '''Prepares the macro configuration bits for `gen_flatten_macro_type`.
+
+        The macro type is stripped from the signatures of the macro DbEntry
+        objects once, instead of for every flattened top DbEntry.
 
         Parameters
         ----------
+        macrotype: str
+            The macro type the DbEntry objects belong to.
         macrodbdata: list
             List of DbEntry objects that contains the macro configuration bits.
+
+        Returns
+        -------
+            list: list of (bitname, signature suffix, wl, bl) tuples
+        '''
+        return [(dbentry.signature.replace('.' + macrotype + '.', ''),
+                 dbentry.signature.replace('.' + macrotype, ''),
+                 dbentry.coords[0].x,
+                 dbentry.coords[0].y)
+                for dbentry in macrodbdata]
+
+    def gen_flatten_macro_type(self, macrobits: list, invertermap: dict):
+        '''Flattens the unflattened DbEntry based on the macro configuration
+        bits that match the macrotype of this DbEntry and yields all flattened
+        entries.
+
+        Parameters
+        ----------
+        macrobits: list
+            List of macro configuration bits, as returned by
+            `strip_macro_type`.
         invertermap: dict
-            Dictionary that for each inverter name tells what inputs are
-            inverted and for what kind of cell.
+            Dictionary that for each (macro type, inverter name) pair tells
+            what inputs are inverted and for what kind of cell.
         '''
-        for dbentry in macrodbdata:
-            bitname = dbentry.signature.replace('.' + self.macrotype + '.', '')
-            newsignature = self.signature + \
-                dbentry.signature.replace('.' + self.macrotype, '')
-            newspectype = self.celltype
-            keymacrotype = self.macrotype
-            # all macrotypes macro_interface* have the same set of bits
-            if keymacrotype.startswith('macro_interface'):
-                keymacrotype = 'macro_interface'
-            if keymacrotype in invertermap and \
-                    bitname in invertermap[keymacrotype]:
-                info = invertermap[keymacrotype][bitname]
+        keymacrotype = self.macrotype
+        # all macrotypes macro_interface* have the same set of bits
+        if keymacrotype.startswith('macro_interface'):
+            keymacrotype = 'macro_interface'
+        # The values below are the same for all flattened bits
+        signature = self.signature
+        celltype = self.celltype
+        devicecoord = self.devicecoord
+        macrotype = self.macrotype
+        topx = self.coords[0].x
+        topy = self.coords[0].y
+        for bitname, signaturesuffix, wl, bl in macrobits:
+            newsignature = signature + signaturesuffix
+            newspectype = celltype
+            info = invertermap.get((keymacrotype, bitname))
+            if info is not None:
                 part = '{}.{}'.format("ZINV" if info["is_zinv"] else "INV",
                                       info["invertedsignals"])
                 newspectype = info["celltype"]
 
-                if newspectype in ['QMUX', 'GMUX']:
+                if newspectype in ('QMUX', 'GMUX'):
                     newsignature += "." + part
                 else:
                     newsignature = part
 
-            newcoord = (self.coords[0].x + dbentry.coords[0].x,
-                        self.coords[0].y + dbentry.coords[0].y)
+            newcoord = (topx + wl, topy + bl)
             assert newcoord[0] < 844 and newcoord[1] < 716, \
                 "Coordinate values are exceeding the maximum values: \
                  computed ({} {}) limit ({} {})".format(newcoord[0],
@@ -322,50 +385,63 @@ class QLDbEntry(DbEntry):
             newentry = QLDbEntry(
                 newsignature,
                 newcoord,
-                self.devicecoord,
-                self.macrotype,
+                devicecoord,
+                macrotype,
                 newspectype)
             newentry.update_signature(True)
             yield newentry
 
 
 def process_csv_data(inputfile: str):
-    '''Converts the CSV file to corresponding CSV line tuples.
+    '''Reads the CSV file line by line.
 
     Parameters
     ----------
     inputfile: str
         Name of the CSV file
 
-    Returns
-    -------
-        list: list of tuples containing CSV fields
+    Yields
+    ------
+        list: CSV fields of a single line
     '''
-    res = []
     with open(inputfile, 'r') as f:
-        reader = csv.reader(f)
-        for row in reader:
-            res.append(row)
-    return res
+        yield from csv.reader(f)
 
 
-def convert_to_db(csvdata: list, flattened=True):
+def convert_to_db(csvdata, flattened=True):
     '''Converts the CSV files to the DB file.
 
     Parameters
     ----------
-    csvdata: list
-        List of lines from parsed CSV file
+    csvdata: iterable
+        Lines from parsed CSV file, e.g. as yielded by `process_csv_data`
     flattened: boolean
         Determines if it contains the unflattened file that needs to be
         processed using the other delivered CSV files.
     '''
-    res = []
-    for row in csvdata:
-        res.append(QLDbEntry.from_csv_line(row)
-                   if flattened
-                   else QLDbEntry.from_csv_line_unflattened(row))
-    return res
+    from_csv_line = (QLDbEntry.from_csv_line
+                     if flattened
+                     else QLDbEntry.from_csv_line_unflattened)
+    return [from_csv_line(row) for row in csvdata]
+
+
+def load_include(macrotype: str, inputfile: str):
+    '''Loads the macro configuration bits from the include CSV file.
+
+    Parameters
+    ----------
+    macrotype: str
+        The macro type described by the include file.
+    inputfile: str
+        Name of the include CSV file
+
+    Returns
+    -------
+        list: list of macro configuration bits, as returned by
+        `QLDbEntry.strip_macro_type`
+    '''
+    dbentries = convert_to_db(process_csv_data(inputfile))
+    return QLDbEntry.strip_macro_type(macrotype, dbentries)
 
 
 if __name__ == "__main__":
@@ -419,7 +495,7 @@ if __name__ == "__main__":
             entry.update_signature(True)
 
         with open(args.outfile, 'w') as output:
-            output.writelines([str(d) for d in dbdata])
+            output.write(''.join(map(str, dbdata)))
         exit(0)
     elif (args.include and not args.macro_names) or \
          (len(args.include) != len(args.macro_names)):
@@ -439,12 +515,12 @@ if __name__ == "__main__":
                    supported by given includes:  {}".format(args.infile,
                                                             macro))
 
-    # Load includes for top
-    macrolibrary = {}
-    for macrotype, include in zip(args.macro_names, args.include):
-        includecsv = process_csv_data(include)
-        dbentries = convert_to_db(includecsv)
-        macrolibrary[macrotype] = dbentries
+    # Load includes for top, the files are independent so they are loaded
+    # in parallel
+    with ProcessPoolExecutor() as executor:
+        macrolibrary = dict(zip(
+            args.macro_names,
+            executor.map(load_include, args.macro_names, args.include)))
 
     # Load techfile for additional information for inverters
     tech_file = TechFile()
@@ -454,66 +530,87 @@ if __name__ == "__main__":
 
     # Convert inv_ports_info hierarchical dictionary so it maps the DB entry
     # name to specific cell type and the list of inverted signals
-    invertermap = defaultdict(dict)
-    for celltype in inv_ports_info.keys():
-        for invtype in inv_ports_info[celltype]:
-            names = [b[0] for b in inv_ports_info[celltype][invtype]]
-            zinv = [b[1] for b in inv_ports_info[celltype][invtype]]
+    invertermap = {}
+    for celltype, invtypes in inv_ports_info.items():
+        for invtype, ports in invtypes.items():
+            names = [b[0] for b in ports]
+            zinv = [b[1] for b in ports]
             assert len(set(zinv)) == 1, (names, zinv)
             invertedsignals = '__'.join(names)
-            macrotype = invtype.split('.')[1]
-            invertername = invtype.replace('.{}.'.format(macrotype), '')
-            invertermap[macrotype][invertername] = {
+            # The inverter names are ".<macrotype>.<invertername>"
+            _, macrotype, invertername = invtype.split('.', 2)
+            invertermap[(macrotype, invertername)] = {
                 'celltype': celltype,
                 'invertedsignals': invertedsignals,
                 'is_zinv': zinv[0]
             }
 
-    coordset = defaultdict(int)
-    nameset = defaultdict(int)
     coordtoorig = {}
-
-    timesrepeated = 0
-    timesrepeatedname = 0
+    nametoorig = {}
+    # All coordinates and names in output order, counted after the loop
+    coords = []
+    names = []
+    maxwl = 0
+    maxbl = 0
 
     flattenedlibrary = []
 
     # Flatten the top database based on inputs
     for dbentry in macrotop:
-        if dbentry.macrotype in macrolibrary:
-            for flattenedentry in dbentry.gen_flatten_macro_type(
-                    macrolibrary[dbentry.macrotype], invertermap):
-                flattenedlibrary.append(flattenedentry)
+        macrobits = macrolibrary.get(dbentry.macrotype)
+        if macrobits is not None:
+            flattenedlibrary.extend(
+                dbentry.gen_flatten_macro_type(macrobits, invertermap))
 
     # Save the final database and perform sanity checks
     with open(args.outfile, 'w') as output:
         with (open(args.routing_bits_outfile, 'w')
                 if args.routing_bits_outfile else nullcontext()) as routingoutput:
+            outputlines = []
+            routinglines = []
             for flattenedentry in flattenedlibrary:
+                entrystr = str(flattenedentry)
                 if flattenedentry.is_routing_bit and args.routing_bits_outfile:
-                    routingoutput.write(str(flattenedentry))
-                else:
-                    output.write(str(flattenedentry))
-                coordstr = str(flattenedentry).split(' ')[-1]
-                featurestr = str(flattenedentry).split(' ')[0]
-                if coordstr not in coordtoorig:
-                    coordtoorig[coordstr] = flattenedentry
+                    routinglines.append(entrystr)
+                    if len(routinglines) >= WRITE_BATCH_SIZE:
+                        routingoutput.write(''.join(routinglines))
+                        routinglines.clear()
                 else:
-                    print("ORIG: {}".format(coordtoorig[coordstr]))
+                    outputlines.append(entrystr)
+                    if len(outputlines) >= WRITE_BATCH_SIZE:
+                        output.write(''.join(outputlines))
+                        outputlines.clear()
+                # Flattened entries have a single bit, at their coord
+                coord = flattenedentry.coord
+                featurestr = flattenedentry.signature
+                origentry = coordtoorig.setdefault(coord, flattenedentry)
+                if origentry is not flattenedentry:
+                    print("ORIG: {}".format(origentry))
                     print("CURR: {}".format(flattenedentry))
-                if coordstr in coordset:
-                    timesrepeated += 1
-                if featurestr in nameset:
+                if nametoorig.setdefault(featurestr,
+                                         flattenedentry) is not flattenedentry:
                     print("ERROR: Duplicated fasm feature '{}'".format(featurestr))
-                    timesrepeatedname += 1
-                coordset[coordstr] += 1
-                nameset[featurestr] += 1
+                coords.append(coord)
+                wl, bl = coord
+                if wl > maxwl:
+                    maxwl = wl
+                if bl > maxbl:
+                    maxbl = bl
+                names.append(featurestr)
+            output.write(''.join(outputlines))
+            if routinglines:
+                routingoutput.write(''.join(routinglines))
+
+    coordset = Counter(coords)
+    nameset = Counter(names)
+
+    # Every occurrence of a coordinate or a name past the first one is a repeat
+    timesrepeated = sum(coordset.values()) - len(coordset)
+    timesrepeatedname = sum(nameset.values()) - len(nameset)
 
     print("Times the coordinates were repeated:  {}".format(timesrepeated))
     print("Max repetition count: {}".format(max(coordset.values())))
     print("Times the names were repeated:  {}".format(timesrepeatedname))
     print("Max repetition count: {}".format(max(nameset.values())))
-    print("Max WL: {}".format(
-        max([int(x.split('_')[0]) for x in coordset.keys()])))
-    print("Max BL: {}".format(
-        max([int(x.split('_')[1]) for x in coordset.keys()])))
+    print("Max WL: {}".format(maxwl))
+    print("Max BL: {}".format(maxbl))
@@ -38,6 +38,9 @@ jlink_footer = [
 header = "uint32_t	axFPGABitStream[] = {\n\t "
 footer = "\n\n};\n"
 
+# Number of bitstream words in a single line of the header
+WORDS_PER_LINE = 10
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description="Converts QuickLogic JLINK script to Header file"
@@ -57,29 +60,18 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
-    line_parser = re.compile(r'^\s*w4 0x40014ffc,\s*(?P<data>[xX0-9a-f]+).*')
+    line_parser = re.compile(
+        r'^[ \t]*w4 0x40014ffc,[ \t]*(?P<data>[xX0-9a-f]+)', re.MULTILINE)
 
-    fp = open(args.infile, 'r') 
-    file_data = fp.readlines()
+    with open(args.infile, 'r') as fp:
+        file_data = fp.read()
 
-    counter = 0
-    headerdata = header
-    for line in file_data:
-        linematch = line_parser.match(line)
-        if linematch:
-            curr_data = linematch.group('data')
-        else:    
-            continue
+    words = [linematch.group('data')
+             for linematch in line_parser.finditer(file_data)]
+    lines = [', '.join(words[i:i + WORDS_PER_LINE])
+             for i in range(0, len(words), WORDS_PER_LINE)]
 
-        headerdata += curr_data
-        counter += 1
-        if counter is 10:
-            headerdata += ",\n\t "
-            counter = 0
-        else:
-            headerdata += ", "
-    
-    data = headerdata[:-4]
+    data = header + ',\n\t '.join(lines)
     data += footer
 
     with open(args.outfile, 'w') as headerfile:
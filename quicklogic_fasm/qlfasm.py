@@ -2,6 +2,8 @@
 from fasm_utils import fasm_assembler
 from fasm import FasmLine
 import math
+import sys
+import array
 import argparse
 import os
 import errno
@@ -39,6 +41,35 @@ class QL732BAssembler(fasm_assembler.FasmAssembler):
 
         self.BANKNUMBITS = math.ceil(self.MAXBL / (self.NUMOFBANKS / 2))
 
+        # For each bitnum, the (banknum, wlshift, bitidx) triples of the bank
+        # bits that are stored in the bitstream word with that bitnum.
+        self.BANKBITS = []
+        for bitnum in range(self.BANKNUMBITS):
+            bankbits = []
+            for banknum in range(self.NUMOFBANKS - 1, -1, -1):
+                # Banks 0, 8, 16 and 24 do not use the first two bits
+                if (banknum & 7) == 0:
+                    if bitnum < 2:
+                        continue
+                    bitidx = self.BANKSTARTBITIDX[banknum] + bitnum - 2
+                else:
+                    bitidx = self.BANKSTARTBITIDX[banknum] + bitnum
+                if banknum >= self.NUMOFBANKS // 2:
+                    wlshift = self.MAXWL // 2
+                else:
+                    wlshift = 0
+                bankbits.append((banknum, wlshift, bitidx))
+            self.BANKBITS.append(bankbits)
+
+        # For each half of the word lines, maps a bit line index to the
+        # (bitnum, banknum) pair it is stored in, or None if it is unused.
+        self.BITIDXTOBANK = ([None] * self.MAXBL, [None] * self.MAXBL)
+        for bitnum, bankbits in enumerate(self.BANKBITS):
+            for banknum, wlshift, bitidx in bankbits:
+                half = wlshift // (self.MAXWL // 2)
+                assert self.BITIDXTOBANK[half][bitidx] is None, bitidx
+                self.BITIDXTOBANK[half][bitidx] = (bitnum, banknum)
+
     def enable_feature(self, fasmline: FasmLine):
         if fasmline.set_feature.value == 0:
             self._configuredbit = False
@@ -52,11 +83,13 @@ class QL732BAssembler(fasm_assembler.FasmAssembler):
                 .format(fasmline)
             )
 
+        set_config_bit = self.set_config_bit
+        clear_config_bit = self.clear_config_bit
         for coord in feature.coords:
             if coord.isset:
-                self.set_config_bit((coord.x, coord.y), fasmline)
+                set_config_bit((coord.x, coord.y), fasmline)
             else:
-                self.clear_config_bit((coord.x, coord.y), fasmline)
+                clear_config_bit((coord.x, coord.y), fasmline)
 
         # TODO: Remove the "configuredbit" test. Not only that it does not have
         # much sense, it also disallows duplicated fasm features in the input
@@ -64,49 +97,42 @@ class QL732BAssembler(fasm_assembler.FasmAssembler):
         self._configuredbit = True
 
     def produce_bitstream(self, outfilepath: str, verbose=False):
-        def get_value_for_coord(wlidx, wlshift, bitidx):
-            coord = (wlidx + wlshift, bitidx)
-            if coord not in self.configbits:
-                return -1
-            else:
-                return self.configbits[coord]
-
-        bitstream = []
-
-        for wlidx in range(self.MAXWL // 2 - 1, -1, -1):
-            for bitnum in range(0, self.BANKNUMBITS):
-                currval = 0
-                for banknum in range(self.NUMOFBANKS - 1, -1, -1):
-                    val = 1
-                    bitidx = 0
-                    if banknum in (0, 8, 16, 24):
-                        if bitnum in (0, 1):
-                            val = 0
-                            continue
-                        else:
-                            bitidx = self.BANKSTARTBITIDX[banknum] + bitnum - 2
-                    else:
-                        bitidx = self.BANKSTARTBITIDX[banknum] + bitnum
-                    if banknum >= self.NUMOFBANKS // 2:
-                        val = get_value_for_coord(wlidx, self.MAXWL // 2, bitidx)
-                    else:
-                        val = get_value_for_coord(wlidx, 0, bitidx)
-
-                    if val == -1:
-                        val = 0
-
-                    if val == 1:
-                        currval = currval | (1 << banknum)
-                if verbose:
-                    print('{}_{}:  {:02X}'.format(wlidx, bitnum, currval))
-                bitstream.append(currval)
+        maxwl = self.MAXWL
+        maxbl = self.MAXBL
+        halfwl = maxwl // 2
+        banknumbits = self.BANKNUMBITS
+        bitidxtobank = self.BITIDXTOBANK
+        bitstream = [0] * (halfwl * banknumbits)
+
+        # Only the set bits contribute to the bitstream, so instead of testing
+        # every bank bit of every word, scatter the set bits into their words.
+        for (wl, bitidx), val in self.configbits.items():
+            if val != 1 or not (0 <= wl < maxwl and 0 <= bitidx < maxbl):
+                continue
+            half, wlidx = divmod(wl, halfwl)
+            bank = bitidxtobank[half][bitidx]
+            if bank is None:
+                continue
+            bitnum, banknum = bank
+            bitstream[(halfwl - 1 - wlidx) * banknumbits + bitnum] |= \
+                1 << banknum
 
         if verbose:
+            print('\n'.join(
+                '{}_{}:  {:02X}'.format(
+                    halfwl - 1 - idx // self.BANKNUMBITS,
+                    idx % self.BANKNUMBITS,
+                    currval)
+                for idx, currval in enumerate(bitstream)))
             print('Size of bitstream:  {}B'.format(len(bitstream) * 4))
 
+        bitstream = array.array('I', bitstream)
+        # The bitstream is stored as little-endian words
+        if sys.byteorder != 'little':
+            bitstream.byteswap()
+
         with open(outfilepath, 'w+b') as output:
-            for batch in bitstream:
-                output.write(batch.to_bytes(4, 'little'))
+            bitstream.tofile(output)
 
     def read_bitstream(self, bitfilepath):
         '''Reads bitstream from file.
@@ -116,41 +142,31 @@ class QL732BAssembler(fasm_assembler.FasmAssembler):
         bitfilepath: str
             A path to the binary file with bitstream
         '''
-        bitstream = []
         with open(bitfilepath, 'rb') as input:
-            while True:
-                bytes = input.read(4)
-                if not bytes:
-                    break
-                bitstream.append(int.from_bytes(bytes, 'little'))
+            data = input.read()
+        # Zero-pad a trailing partial word, so it reads as a little-endian
+        # value like the full ones
+        data += bytes(-len(data) % 4)
 
-        def set_bit(wlidx, wlshift, bitidx, value):
-            coord = (wlidx + wlshift, bitidx)
-            if value == 1:
-                self.set_config_bit(coord, None)
-            else:
-                self.clear_config_bit(coord, None)
+        bitstream = array.array('I')
+        bitstream.frombytes(data)
+        if sys.byteorder != 'little':
+            bitstream.byteswap()
+
+        set_config_bit = self.set_config_bit
+        clear_config_bit = self.clear_config_bit
+        bankbits = self.BANKBITS
 
         val = iter(bitstream)
         for wlidx in reversed(range(self.MAXWL // 2)):
             for bitnum in range(self.BANKNUMBITS):
                 currval = next(val)
-                for banknum in reversed(range(self.NUMOFBANKS)):
-                    bit = (currval >> banknum) & 1
-                    bitidx = 0
-
-                    if banknum in (0, 8, 16, 24):
-                        if bitnum in (0, 1):
-                            continue
-                        else:
-                            bitidx = self.BANKSTARTBITIDX[banknum] + bitnum - 2
-                    else:
-                        bitidx = self.BANKSTARTBITIDX[banknum] + bitnum
-
-                    if banknum >= self.NUMOFBANKS // 2:
-                        set_bit(wlidx, self.MAXWL // 2, bitidx, bit)
+                for banknum, wlshift, bitidx in bankbits[bitnum]:
+                    coord = (wlidx + wlshift, bitidx)
+                    if (currval >> banknum) & 1:
+                        set_config_bit(coord, None)
                     else:
-                        set_bit(wlidx, 0, bitidx, bit)
+                        clear_config_bit(coord, None)
 
     def disassemble(self, outfilepath: str = None, verbose=False):
         '''Converts bitstream to FASM lines.
@@ -169,19 +185,19 @@ class QL732BAssembler(fasm_assembler.FasmAssembler):
         -------
         list: A list of FASM lines
         '''
-        unknown_bits = set([coord for coord, val in self.configbits.items()
-                            if bool(val)])
+        configbits = self.configbits
+        unknown_bits = set(coord for coord, val in configbits.items() if val)
 
         features = []
         for feature in self.db:
             for bit in feature.coords:
-                coord = (bit.x, bit.y)
-                if coord not in self.configbits \
-                        or bool(self.configbits[coord]) != bit.isset:
+                val = configbits.get((bit.x, bit.y))
+                if val is None or bool(val) != bit.isset:
                     break
             else:
                 features.append(feature.signature)
-                unknown_bits -= set([(bit.x, bit.y) for bit in feature.coords])
+                unknown_bits.difference_update(
+                    (bit.x, bit.y) for bit in feature.coords)
                 if verbose:
                     print(f'{feature.signature}')
 
@@ -189,10 +205,8 @@ class QL732BAssembler(fasm_assembler.FasmAssembler):
             with open(outfilepath, 'w') as fasm_file:
                 print(*features, sep='\n', file=fasm_file)
 
-                if len(unknown_bits):
-                    for bit in unknown_bits:
-                        print(f'{{ unknown_bit =  "{bit.x}_{bit.y}"}}',
-                              file=fasm_file)
+                for x, y in sorted(unknown_bits):
+                    print(f'{{ unknown_bit =  "{x}_{y}"}}', file=fasm_file)
         return features
 
 
@@ -216,6 +230,48 @@ def load_quicklogic_database(db_root=DB_FILES_DIR):
     return db
 
 
+def assemble_file(db, fasmfilepath, bitfilepath, verbose=False):
+    '''Converts FASM file to the bitstream file.
+
+    Parameters
+    ----------
+    db: Database
+        The QuickLogic Database, as returned by `load_quicklogic_database`
+    fasmfilepath: str
+        A path to the input FASM file
+    bitfilepath: str
+        A path to the output bitstream file
+    verbose: bool
+        If true, the verbose messages will be printed in stdout
+    '''
+    assembler = QL732BAssembler(db)
+    assembler.parse_fasm_filename(fasmfilepath)
+    assembler.produce_bitstream(bitfilepath, verbose=verbose)
+
+
+def disassemble_file(db, bitfilepath, fasmfilepath, verbose=False):
+    '''Converts bitstream file to the FASM file.
+
+    Parameters
+    ----------
+    db: Database
+        The QuickLogic Database, as returned by `load_quicklogic_database`
+    bitfilepath: str
+        A path to the input bitstream file
+    fasmfilepath: str
+        A path to the output FASM file
+    verbose: bool
+        If true, the verbose messages will be printed in stdout
+
+    Returns
+    -------
+    list: A list of FASM lines
+    '''
+    assembler = QL732BAssembler(db)
+    assembler.read_bitstream(bitfilepath)
+    return assembler.disassemble(fasmfilepath, verbose=verbose)
+
+
 def main():
 
     parser = argparse.ArgumentParser(
@@ -265,14 +321,10 @@ def main():
 
     db = load_quicklogic_database(args.db_root)
 
-    assembler = QL732BAssembler(db)
-
     if not args.disassemble:
-        assembler.parse_fasm_filename(args.infile)
-        assembler.produce_bitstream(args.outfile, verbose=args.verbose)
+        assemble_file(db, args.infile, args.outfile, verbose=args.verbose)
     else:
-        assembler.read_bitstream(args.infile)
-        assembler.disassemble(args.outfile, verbose=args.verbose)
+        disassemble_file(db, args.infile, args.outfile, verbose=args.verbose)
 
 
 if __name__ == "__main__":